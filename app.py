@@ -3,30 +3,118 @@ Optical Design Chat Backend
 FastAPI server that receives optical design requests and uses Claude API to generate designs.
 """
 
-from fastapi import FastAPI, HTTPException
+from anyio import to_thread
+from blake3 import blake3
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
 from pydantic import BaseModel, Field
-from typing import List, Literal, Optional, Union
+from typing import Any, Callable, Coroutine, Dict, List, Literal, Optional, Tuple, Union
+import aiofiles
+import aiofiles.os
 import anthropic
-import json
+import asyncio
+import fastjsonschema
+import httpx
+import ijson
+import orjson
 import os
+import re
+import uuid
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="Optical Design Chat API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Per-worker startup and shutdown.
+    Creates the prompts directory once instead of on every save, and opens the
+    Anthropic client inside the worker so its connection pool is never shared
+    across forked processes.
+    """
+    global client
+
+    os.makedirs(os.path.dirname(SYSTEM_PROMPT_FILE), exist_ok=True)
+
+    # Bound the threads run_in_threadpool may use for CPU-bound work (semantic
+    # cache embedding) so a burst of requests can't crowd out the event loop
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+    # Async client so in-flight Claude calls don't block the event loop; the
+    # pooled connections are reused across requests instead of re-opening TLS,
+    # and HTTP/2 multiplexes concurrent calls over them
+    client = anthropic.AsyncAnthropic(
+        api_key=ANTHROPIC_API_KEY,
+        timeout=anthropic.Timeout(120.0, connect=10.0),
+        http_client=anthropic.DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        )
+    )
+    try:
+        yield
+    finally:
+        await client.close()
+
+
+app = FastAPI(
+    title="Optical Design Chat API",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
+
+class ORJSONRequest(Request):
+    """Request whose JSON body is parsed with orjson instead of the stdlib json module."""
+
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+
+class ORJSONRoute(APIRoute):
+    """Route class that hands request bodies to FastAPI's validation via ORJSONRequest."""
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        original_route_handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            return await original_route_handler(ORJSONRequest(request.scope, request.receive))
+
+        return route_handler
+
+
+# Must be set before any route is declared
+app.router.route_class = ORJSONRoute
 
 # Enable CORS for your frontend
-# Get allowed origins from environment variable or use default
-ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "*").split(",")
+# Get allowed origins from environment variable or use default; a frozenset
+# makes the middleware's per-request origin check a hash lookup
+ALLOWED_ORIGINS = frozenset(
+    origin.strip()
+    for origin in os.getenv("ALLOWED_ORIGINS", "*").split(",")
+    if origin.strip()
+)
+
+# Browsers reject credentialed responses with a wildcard origin, so only
+# allow credentials when explicit origins are configured
+ALLOW_CREDENTIALS = "*" not in ALLOWED_ORIGINS
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=ALLOWED_ORIGINS,  # Configure via ALLOWED_ORIGINS env var
-    allow_credentials=True,
-    allow_methods=["*"],
+    allow_credentials=ALLOW_CREDENTIALS,
+    allow_methods=["GET", "POST", "DELETE"],
     allow_headers=["*"],
+    max_age=7200,  # Let browsers cache preflights (Chromium caps at 2 hours)
 )
 
 # Initialize Anthropic client
@@ -34,10 +122,57 @@ ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 if not ANTHROPIC_API_KEY:
     raise ValueError("ANTHROPIC_API_KEY environment variable is required")
 
-client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+# Created per worker in lifespan()
+client: Optional[anthropic.AsyncAnthropic] = None
+
+CLAUDE_MODEL = "claude-sonnet-4-5-20250929"  # Claude Sonnet 4.5
+# Design JSON is typically 200-800 tokens, so default well below the old 4096;
+# requests may raise it per call up to MAX_TOKENS_LIMIT
+MAX_TOKENS = int(os.getenv("MAX_TOKENS", "1500"))
+MAX_TOKENS_LIMIT = int(os.getenv("MAX_TOKENS_LIMIT", "4096"))
+
+# Give up on a non-streaming Claude call after this long and answer 504, so a
+# stalled call doesn't hold the client connection and a pooled socket
+CLAUDE_TIMEOUT_SECONDS = float(os.getenv("CLAUDE_TIMEOUT_SECONDS", "60"))
+
+# Worker threads for blocking work offloaded from the event loop
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "16"))
+
+# Claude calls currently in flight, keyed by a hash of their inputs
+_inflight: Dict[bytes, asyncio.Future] = {}
+
+# Exact-match cache of finished /api/design and /api/chat payloads, least
+# recently used first; 0 disables it
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+_response_cache: "OrderedDict[bytes, dict]" = OrderedDict()
+
+# Disable proxy buffering so SSE chunks reach the client as they are generated
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+# Last frame of a successful stream, for clients that only read data lines
+STREAM_DONE = b'data: {"done":true}\n\n'
+
+# Optional semantic response cache (needs sentence-transformers and faiss-cpu)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED:
+    from semantic_cache import SemanticCache
+
+    semantic_cache = SemanticCache(
+        db_path=os.getenv("SEMANTIC_CACHE_DB", os.path.join("cache", "semantic_cache.db")),
+        threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.93")),
+        ttl_seconds=float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "86400")),
+        max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1024")),
+    )
+
+
+# Request models
+class ChatMessage(BaseModel):
+    """One earlier turn of the conversation"""
+    role: Literal["user", "assistant"]
+    content: str = Field(..., min_length=1)
 
 
-# Request model
 class OpticalDesignRequest(BaseModel):
     """Request model for optical design generation"""
     user_message: str = Field(..., description="User's optical design requirement")
@@ -45,6 +180,10 @@ class OpticalDesignRequest(BaseModel):
         default=None,
         description="Custom system instruction to guide the design generation"
     )
+    conversation_history: Optional[List[ChatMessage]] = Field(
+        default=None,
+        description="Earlier turns of the conversation, oldest first"
+    )
     previous_design: Optional[dict] = Field(
         default=None,
         description="Previous optical design for memory/iteration context"
@@ -53,6 +192,12 @@ class OpticalDesignRequest(BaseModel):
         default=None,
         description="Additional data that might be useful for future extensions"
     )
+    max_tokens: Optional[int] = Field(
+        default=None,
+        ge=1,
+        le=MAX_TOKENS_LIMIT,
+        description="Override the maximum number of tokens Claude may generate"
+    )
 
 
 # Response models matching your schema
@@ -95,6 +240,39 @@ class OpticalDesign(BaseModel):
     image_plane_x_mm: float
 
 
+# Built once; Pydantic re-walks the models on every model_json_schema() call
+OPTICAL_DESIGN_SCHEMA = OpticalDesign.model_json_schema()
+OPTICAL_DESIGN_SCHEMA_JSON = orjson.dumps(OPTICAL_DESIGN_SCHEMA)
+
+# Compiled once from the Pydantic schema; validates Claude's design output
+# without instantiating the nested models
+validate_design = fastjsonschema.compile(OPTICAL_DESIGN_SCHEMA)
+
+# /api/design forces Claude to answer through this tool, so the design arrives
+# as structured tool input rather than JSON embedded in prose. Explanation is
+# listed first so streaming clients get it before the numeric design.
+DESIGN_TOOL = {
+    "name": "emit_design",
+    "description": "Return the optical design",
+    "input_schema": {
+        **OPTICAL_DESIGN_SCHEMA,
+        "properties": {
+            "explanation": {
+                "type": "string",
+                "description": "Brief explanation of the design choices"
+            },
+            **OPTICAL_DESIGN_SCHEMA["properties"]
+        }
+    }
+}
+DESIGN_TOOL_PARAMS = {
+    "tools": [DESIGN_TOOL],
+    "tool_choice": {"type": "tool", "name": DESIGN_TOOL["name"]}
+}
+
+
+# Endpoint response models document the API in OpenAPI (via `responses=`);
+# handlers return ORJSONResponse directly so FastAPI doesn't re-validate them
 class OpticalDesignResponse(BaseModel):
     """Response model containing the optical design"""
     design: OpticalDesign
@@ -118,6 +296,27 @@ class SystemPromptSaveResponse(BaseModel):
     message: str
 
 
+# Batch Design Models
+class BatchDesignRequest(BaseModel):
+    """Request model for submitting several design requests as one batch"""
+    requests: List[OpticalDesignRequest] = Field(..., min_length=1, description="Design requests to run")
+
+
+class BatchDesignResult(BaseModel):
+    """Outcome of one request in a finished batch"""
+    custom_id: str
+    result: Optional[OpticalDesignResponse] = None
+    error: Optional[str] = None
+
+
+class BatchDesignResponse(BaseModel):
+    """Response model for batch submission and status; results are set once the batch has ended"""
+    batch_id: str
+    status: Literal["in_progress", "canceling", "ended"]
+    request_counts: Dict[str, int]
+    results: Optional[List[BatchDesignResult]] = None
+
+
 # System prompt for Claude
 SYSTEM_PROMPT = """You are an expert optical engineer specializing in lens design. Users will describe their optical design requirements, and you must generate complete, valid optical designs.
 
@@ -174,37 +373,515 @@ Respond ONLY with the JSON object, no markdown code blocks, no explanations outs
 If you want to provide an explanation, include it as a top-level "explanation" field in the JSON."""
 
 
+# JSON object wrapped in a markdown code fence, with or without a "json" tag
+JSON_FENCE = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.DOTALL)
+
+# custom_id given to each request by /api/design/batch; batches whose results
+# don't all match were not created there
+BATCH_CUSTOM_ID = re.compile(r"design-(\d+)")
+
+# Headers for the context message built from previous_design / added_data
+PREVIOUS_DESIGN_HEADER = "PREVIOUS DESIGN (for reference/iteration):\n"
+ADDITIONAL_CONTEXT_HEADER = "ADDITIONAL CONTEXT:\n"
+CONTEXT_SEPARATOR = "\n\n"
+
+# Assistant turn sent after the previous design / additional context message
+CONTEXT_ACKNOWLEDGMENT = {
+    "role": "assistant",
+    "content": "I've noted the previous design and additional context. I'll use this information to help with the current request."
+}
+
+
 # System Prompt File Management
 SYSTEM_PROMPT_FILE = os.path.join("prompts", "system_prompt.txt")
 
 
+def content_etag(content: str) -> str:
+    """Strong ETag (quoted blake3 hex digest) for a piece of text."""
+    return f'"{blake3(content.encode("utf-8")).hexdigest()}"'
+
+
+EMPTY_PROMPT_ETAG = content_etag("")
+
+# In-memory copy of the custom instructions, reloaded when the file's stamp
+# changes; the ETag is recomputed only when the content does
+_prompt_cache = {"stamp": None, "content": "", "etag": EMPTY_PROMPT_ETAG}
+
+
+def _file_stamp(st: os.stat_result) -> Tuple[int, int, int]:
+    """
+    Identify a version of the custom instructions file.
+    mtime alone can miss two saves within one coarse timestamp tick (FAT,
+    NTFS, network mounts); every save replaces the file, so it also gets a
+    new inode.
+    """
+    return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+
+def _set_prompt_cache(stamp: Optional[Tuple[int, int, int]], content: str) -> None:
+    """Update the cached custom instructions and their ETag."""
+    _prompt_cache["stamp"] = stamp
+    if content != _prompt_cache["content"]:
+        _prompt_cache["content"] = content
+        _prompt_cache["etag"] = content_etag(content)
+
+
 def get_custom_instructions() -> str:
     """
     Load custom instructions from file storage.
     Returns empty string if file doesn't exist or is empty.
     These instructions will be appended to the base SYSTEM_PROMPT.
+    The file is only re-read when its mtime, inode or size changes.
     """
     try:
-        if os.path.exists(SYSTEM_PROMPT_FILE):
-            with open(SYSTEM_PROMPT_FILE, "r", encoding="utf-8") as f:
-                content = f.read().strip()
-                return content
+        stamp = _file_stamp(os.stat(SYSTEM_PROMPT_FILE))
+    except FileNotFoundError:
+        _set_prompt_cache(None, "")
         return ""
+
+    try:
+        if stamp != _prompt_cache["stamp"]:
+            with open(SYSTEM_PROMPT_FILE, "r", encoding="utf-8") as f:
+                _set_prompt_cache(stamp, f.read().strip())
+        return _prompt_cache["content"]
     except Exception as e:
         print(f"Error reading custom instructions file: {e}")
         return ""
 
 
-def save_system_prompt(content: str) -> None:
+async def save_system_prompt(content: str) -> None:
     """
     Save the system prompt to file storage.
-    Creates the prompts directory if it doesn't exist.
+    Writes to a temporary file and atomically replaces the target, so readers
+    never see a half-written file. The prompts directory is created at startup.
     """
-    # Ensure prompts directory exists
-    os.makedirs(os.path.dirname(SYSTEM_PROMPT_FILE), exist_ok=True)
+    tmp_file = f"{SYSTEM_PROMPT_FILE}.{uuid.uuid4().hex}.tmp"
+    try:
+        async with aiofiles.open(tmp_file, "w", encoding="utf-8") as f:
+            await f.write(content)
+        # Stat our own file: after the replace, a concurrent save may already
+        # have swapped in its file. The rename keeps inode, mtime and size
+        stamp = _file_stamp(await aiofiles.os.stat(tmp_file))
+        await aiofiles.os.replace(tmp_file, SYSTEM_PROMPT_FILE)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+    # Refresh the in-memory copy so the next request doesn't re-read the file
+    _set_prompt_cache(stamp, content.strip())
+
 
-    with open(SYSTEM_PROMPT_FILE, "w", encoding="utf-8") as f:
-        f.write(content)
+def build_system_blocks(system_message: Optional[str] = None) -> List[dict]:
+    """
+    Build the Claude system prompt as a list of text blocks.
+    The hardcoded base prompt and the stored custom instructions change rarely,
+    so the cache breakpoint goes on the last of them. The per-request
+    system_message comes after the breakpoint so it never invalidates the
+    prefix. Anthropic only caches a prefix (tools + system blocks up to the
+    breakpoint) of at least 1024 tokens on Sonnet; the base prompt alone is
+    about 600, so a request without tools or custom instructions (plain
+    /api/chat) is not cached.
+    """
+    return _compose_system_blocks(get_custom_instructions(), system_message or None)
+
+
+@lru_cache(maxsize=256)
+def _compose_system_blocks(custom_instructions: str, system_message: Optional[str]) -> List[dict]:
+    """
+    Compose the system blocks for one (custom instructions, system_message) pair.
+    Memoized so repeated combinations reuse the same list; callers must not mutate it.
+    """
+    blocks = [{"type": "text", "text": SYSTEM_PROMPT}]
+
+    # Append custom instructions from file if they exist
+    if custom_instructions:
+        blocks.append({
+            "type": "text",
+            "text": f"CUSTOM INSTRUCTIONS:\n{custom_instructions}"
+        })
+
+    blocks[-1]["cache_control"] = {"type": "ephemeral"}
+
+    # If per-request system_message is provided, append it uncached
+    if system_message:
+        blocks.append({
+            "type": "text",
+            "text": f"ADDITIONAL INSTRUCTIONS:\n{system_message}"
+        })
+
+    return blocks
+
+
+def build_messages(request: OpticalDesignRequest) -> List[dict]:
+    """
+    Build the Claude message list for a request.
+    Any conversation history comes first. previous_design and added_data are
+    then sent as a context message followed by an assistant acknowledgment,
+    and the current user message comes last.
+    """
+    history = [message.model_dump() for message in request.conversation_history or ()]
+
+    # Common case: no context, just the user message
+    if not request.previous_design and not request.added_data:
+        return history + [{"role": "user", "content": request.user_message}]
+
+    # Build context message from previous_design and/or added_data
+    context_parts = []
+
+    if request.previous_design:
+        context_parts.append(
+            PREVIOUS_DESIGN_HEADER
+            + orjson.dumps(request.previous_design, option=orjson.OPT_INDENT_2).decode()
+        )
+
+    if request.added_data:
+        context_parts.append(
+            ADDITIONAL_CONTEXT_HEADER
+            + orjson.dumps(request.added_data, option=orjson.OPT_INDENT_2).decode()
+        )
+
+    # Context first, then the assistant acknowledgment, then the current user message
+    return history + [
+        {"role": "user", "content": CONTEXT_SEPARATOR.join(context_parts)},
+        CONTEXT_ACKNOWLEDGMENT,
+        {"role": "user", "content": request.user_message},
+    ]
+
+
+def message_params(system_blocks: List[dict], messages: List[dict], max_tokens: int,
+                   params: Optional[dict] = None) -> dict:
+    """Messages API arguments shared by the create, stream and batch calls."""
+    return {
+        "model": CLAUDE_MODEL,
+        "max_tokens": max_tokens,
+        "system": system_blocks,
+        "messages": messages,
+        **(params or {})
+    }
+
+
+def request_key(*parts: Any) -> bytes:
+    """blake3 digest of the JSON encoding of parts, for keying in-memory caches."""
+    return blake3(orjson.dumps(parts)).digest()
+
+
+async def create_message(system_blocks: List[dict], messages: List[dict],
+                         max_tokens: int, params: Optional[dict] = None) -> anthropic.types.Message:
+    """
+    Call Claude, coalescing concurrent identical requests.
+    The first caller for a given (system, messages, params) combination starts
+    the API call; callers that arrive while it is in flight await the same task
+    instead of making their own. The task is shielded so one client
+    disconnecting doesn't cancel the call for the others, but the call itself
+    is cancelled after CLAUDE_TIMEOUT_SECONDS, raising asyncio.TimeoutError for
+    every caller. params holds extra Messages API arguments such as tools.
+    """
+    key = request_key(system_blocks, messages, max_tokens, params)
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.wait_for(
+            client.messages.create(**message_params(system_blocks, messages, max_tokens, params)),
+            timeout=CLAUDE_TIMEOUT_SECONDS
+        ))
+        _inflight[key] = task
+        task.add_done_callback(
+            lambda done: _inflight.pop(key) if _inflight.get(key) is done else None
+        )
+
+    return await asyncio.shield(task)
+
+
+def parse_claude_json(response_text: str) -> Tuple[Any, str]:
+    """
+    Parse Claude's response text as JSON.
+    Falls back to the first markdown-fenced block (```json or bare ```) if the
+    text itself isn't JSON, then to the outermost {...} for unfenced JSON
+    surrounded by prose. Returns the parsed data and the JSON text it came
+    from; raises orjson.JSONDecodeError if none parses.
+    """
+    try:
+        return orjson.loads(response_text), response_text
+    except orjson.JSONDecodeError:
+        match = JSON_FENCE.search(response_text)
+        if match is not None:
+            json_text = match.group(1)
+        else:
+            start = response_text.find("{")
+            end = response_text.rfind("}")
+            if start < 0 or end < start:
+                raise
+            json_text = response_text[start:end + 1]
+        return orjson.loads(json_text), json_text
+
+
+def build_design_response(design_data: dict) -> dict:
+    """
+    Validate Claude's design and split it into an OpticalDesignResponse payload.
+    Raises HTTPException (422) if it doesn't match the design schema.
+    """
+    # Validate against the compiled schema (extra keys such as explanation are allowed)
+    try:
+        validate_design(design_data)
+    except fastjsonschema.JsonSchemaException as e:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Claude response does not match the optical design schema: {e.message}"
+        )
+
+    # Extract explanation if present
+    explanation = design_data.pop("explanation", None)
+
+    return {"design": design_data, "explanation": explanation}
+
+
+def design_result(message: anthropic.types.Message) -> dict:
+    """Build the /api/design payload from Claude's emit_design tool call."""
+    # A truncated design is incomplete; say why instead of failing validation
+    if message.stop_reason == "max_tokens":
+        raise HTTPException(
+            status_code=500,
+            detail="Claude response was cut off at max_tokens; retry with a higher max_tokens"
+        )
+
+    tool_use = next((block for block in message.content if block.type == "tool_use"), None)
+    if tool_use is None:
+        raise HTTPException(status_code=500, detail="Claude did not return a design")
+
+    # Copy: coalesced callers share the message, and the payload is edited in place
+    return build_design_response(dict(tool_use.input))
+
+
+def chat_result(message: anthropic.types.Message) -> dict:
+    """
+    Build the /api/chat payload from Claude's message.
+    Returns a design if the text parses as JSON, otherwise the raw text.
+    truncated is set when Claude stopped at max_tokens, which also turns a
+    design cut off mid-JSON into a text payload.
+    """
+    response_text = message.content[0].text.strip()
+    truncated = message.stop_reason == "max_tokens"
+    try:
+        design_data, json_text = parse_claude_json(response_text)
+        return {
+            "type": "design",
+            "data": design_data,
+            "raw_response": json_text,
+            "truncated": truncated
+        }
+    except orjson.JSONDecodeError:
+        # Return as text if not JSON
+        return {
+            "type": "text",
+            "message": response_text,
+            "raw_response": response_text,
+            "truncated": truncated
+        }
+
+
+async def generate(request: OpticalDesignRequest, endpoint: str,
+                   build_result: Callable[[anthropic.types.Message], dict],
+                   params: Optional[dict] = None) -> dict:
+    """
+    Shared core of /api/design and /api/chat.
+    Builds the prompt, serves repeated requests from the exact-match cache and
+    near-duplicates from the semantic cache, calls Claude (coalesced with
+    identical in-flight requests) with any extra params and turns the reply
+    into the endpoint's payload with build_result.
+    """
+    # Build the system prompt blocks (base + custom instructions are cached)
+    system_blocks = build_system_blocks(request.system_message)
+    messages = build_messages(request)
+    max_tokens = request.max_tokens or MAX_TOKENS
+
+    # Identical requests are answered from memory without any model work
+    key = request_key(endpoint, system_blocks, messages, max_tokens, params)
+    cached = _response_cache.get(key)
+    if cached is not None:
+        _response_cache.move_to_end(key)
+        return cached
+
+    # Serve near-duplicate requests from the semantic cache
+    if semantic_cache is not None:
+        # Everything but the final user message must match exactly
+        cache_scope = semantic_cache.scope(endpoint, system_blocks, messages[:-1])
+        embedding = await run_in_threadpool(semantic_cache.embed, request.user_message)
+        cached = await run_in_threadpool(semantic_cache.lookup, embedding, cache_scope)
+        if cached is not None:
+            return cached
+
+    response = await create_message(system_blocks, messages, max_tokens, params)
+    result = build_result(response)
+
+    if RESPONSE_CACHE_MAX_ENTRIES > 0:
+        _response_cache[key] = result
+        while len(_response_cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            _response_cache.popitem(last=False)
+
+    # The semantic scope ignores max_tokens, so a cut-off answer must not be
+    # served to a request that allows a longer one
+    if semantic_cache is not None and not result.get("truncated"):
+        # Workers share the SQLite file; a failed cache write (e.g. "database
+        # is locked") must not turn a good answer into an error
+        try:
+            await run_in_threadpool(semantic_cache.add, embedding, cache_scope, result)
+        except Exception as e:
+            print(f"Error writing semantic cache entry: {e}")
+
+    return result
+
+
+def stream_response(request: OpticalDesignRequest, build_result: Callable[[anthropic.types.Message], dict],
+                    event: str, error_message: str, params: Optional[dict] = None,
+                    stream_explanation: bool = False) -> StreamingResponse:
+    """
+    Shared core of the SSE endpoints.
+    Emits a data frame with each text (or tool input JSON) chunk as Claude
+    generates it, then a frame of the given event type with build_result's
+    payload and a final {"done": true} data frame, or an "error" event if
+    generation or parsing fails. With stream_explanation, an "explanation"
+    event is also sent as soon as the design's explanation field has been
+    generated.
+    """
+    stream_params = message_params(
+        build_system_blocks(request.system_message),
+        build_messages(request),
+        request.max_tokens or MAX_TOKENS,
+        params
+    )
+
+    async def event_stream():
+        watcher = ExplanationWatcher() if stream_explanation else None
+        try:
+            async with client.messages.stream(**stream_params) as stream:
+                async for stream_event in stream:
+                    if stream_event.type == "text":
+                        text = stream_event.text
+                    elif stream_event.type == "input_json":
+                        text = stream_event.partial_json
+                    else:
+                        continue
+
+                    yield sse_event(orjson.dumps({"token": text}))
+                    if watcher is not None:
+                        explanation = watcher.feed(text)
+                        if explanation is not None:
+                            yield sse_event(orjson.dumps({"explanation": explanation}), event="explanation")
+                message = await stream.get_final_message()
+
+            yield sse_event(orjson.dumps(build_result(message)), event=event)
+            yield STREAM_DONE
+
+        except anthropic.APIError as e:
+            yield sse_event(orjson.dumps({"detail": f"Anthropic API error: {str(e)}"}), event="error")
+        except HTTPException as e:
+            yield sse_event(orjson.dumps({"detail": e.detail}), event="error")
+        except Exception as e:
+            yield sse_event(orjson.dumps({"detail": f"{error_message}: {str(e)}"}), event="error")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
+
+def batch_status(batch: anthropic.types.messages.MessageBatch) -> dict:
+    """Build the BatchDesignResponse payload for a batch, without results."""
+    return {
+        "batch_id": batch.id,
+        "status": batch.processing_status,
+        "request_counts": batch.request_counts.model_dump()
+    }
+
+
+async def batch_results(batch_id: str) -> List[dict]:
+    """
+    Collect a finished batch's design results in request order.
+    Raises HTTPException (404) if the batch was not created by
+    /api/design/batch, so other batches on the API key are not exposed.
+    """
+    results = []
+    order = {}
+    async for entry in await client.messages.batches.results(batch_id):
+        match = BATCH_CUSTOM_ID.fullmatch(entry.custom_id)
+        if match is None:
+            raise HTTPException(status_code=404, detail="Batch not found")
+        order[entry.custom_id] = int(match.group(1))
+
+        item = {"custom_id": entry.custom_id}
+        if entry.result.type == "succeeded":
+            try:
+                item["result"] = design_result(entry.result.message)
+            except HTTPException as e:
+                item["error"] = e.detail
+        elif entry.result.type == "errored":
+            item["error"] = f"Anthropic API error: {entry.result.error.error.message}"
+        else:
+            item["error"] = f"Request {entry.result.type}"
+        results.append(item)
+
+    # Results come back in arbitrary order
+    results.sort(key=lambda item: order[item["custom_id"]])
+    return results
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header (weak comparison, lists and "*" allowed)."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def sse_event(data: bytes, event: Optional[str] = None) -> bytes:
+    """Format a JSON payload as a Server-Sent Events frame."""
+    if event:
+        return b"event: " + event.encode() + b"\ndata: " + data + b"\n\n"
+    return b"data: " + data + b"\n\n"
+
+
+class ExplanationWatcher:
+    """
+    Incrementally parses streamed design JSON and reports the top-level
+    "explanation" string as soon as its closing quote arrives, long before
+    the rest of the design is complete.
+    """
+
+    def __init__(self):
+        self._found = ijson.sendable_list()
+        self._parser = ijson.items_coro(self._found, "explanation")
+        self._started = False
+        self.done = False
+
+    def feed(self, text: str) -> Optional[str]:
+        """Feed the next text chunk; returns the explanation once it is complete."""
+        if self.done:
+            return None
+        if not self._started:
+            # Skip anything before the object, such as a ```json fence
+            start = text.find("{")
+            if start < 0:
+                return None
+            text = text[start:]
+            self._started = True
+
+        try:
+            self._parser.send(text.encode("utf-8"))
+        except ijson.JSONError:
+            # Malformed or fenced output; the final parse reports real errors
+            self.done = True
+            return None
+
+        if self._found:
+            self.done = True
+            if isinstance(self._found[0], str):
+                return self._found[0]
+        return None
 
 
 @app.get("/")
@@ -213,16 +890,31 @@ async def root():
     return {"status": "ok", "message": "Optical Design Chat API is running"}
 
 
-@app.get("/api/system-prompt", response_model=SystemPromptResponse)
-async def get_system_prompt():
+@app.get("/api/schema")
+async def get_design_schema():
+    """
+    JSON Schema of the optical design object returned by /api/design.
+    """
+    return Response(content=OPTICAL_DESIGN_SCHEMA_JSON, media_type="application/json")
+
+
+@app.get("/api/system-prompt", responses={200: {"model": SystemPromptResponse}})
+async def get_system_prompt(request: Request):
     """
     Get the current custom instructions.
     Returns only the custom instructions appended to the base prompt.
     Returns empty string if no custom instructions are set.
+    Responds 304 Not Modified when If-None-Match matches the current ETag.
     """
     try:
         content = get_custom_instructions()
-        return SystemPromptResponse(content=content)
+        etag = _prompt_cache["etag"]
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+
+        return ORJSONResponse({"content": content}, headers=headers)
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -230,7 +922,7 @@ async def get_system_prompt():
         )
 
 
-@app.post("/api/system-prompt", response_model=SystemPromptSaveResponse)
+@app.post("/api/system-prompt", responses={200: {"model": SystemPromptSaveResponse}})
 async def update_system_prompt(request: SystemPromptRequest):
     """
     Save custom instructions to append to the base system prompt.
@@ -239,12 +931,12 @@ async def update_system_prompt(request: SystemPromptRequest):
     try:
         # Allow empty content (to clear custom instructions)
         # Save the custom instructions
-        save_system_prompt(request.content)
+        await save_system_prompt(request.content)
 
-        return SystemPromptSaveResponse(
-            success=True,
-            message="Custom instructions saved successfully"
-        )
+        return ORJSONResponse({
+            "success": True,
+            "message": "Custom instructions saved successfully"
+        })
     except HTTPException:
         raise
     except Exception as e:
@@ -254,7 +946,7 @@ async def update_system_prompt(request: SystemPromptRequest):
         )
 
 
-@app.delete("/api/system-prompt", response_model=SystemPromptSaveResponse)
+@app.delete("/api/system-prompt", responses={200: {"model": SystemPromptSaveResponse}})
 async def delete_system_prompt():
     """
     Clear custom instructions and revert to using only the base system prompt.
@@ -263,10 +955,10 @@ async def delete_system_prompt():
         if os.path.exists(SYSTEM_PROMPT_FILE):
             os.remove(SYSTEM_PROMPT_FILE)
 
-        return SystemPromptSaveResponse(
-            success=True,
-            message="Custom instructions cleared successfully"
-        )
+        return ORJSONResponse({
+            "success": True,
+            "message": "Custom instructions cleared successfully"
+        })
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -274,7 +966,7 @@ async def delete_system_prompt():
         )
 
 
-@app.post("/api/design", response_model=OpticalDesignResponse)
+@app.post("/api/design", responses={200: {"model": OpticalDesignResponse}})
 async def generate_optical_design(request: OpticalDesignRequest):
     """
     Generate an optical design based on user requirements.
@@ -287,91 +979,12 @@ async def generate_optical_design(request: OpticalDesignRequest):
         OpticalDesignResponse containing the generated optical design
     """
     try:
-        # Build the system prompt - always start with the hardcoded base
-        system_prompt = SYSTEM_PROMPT
-
-        # Append custom instructions from file if they exist
-        custom_instructions = get_custom_instructions()
-        if custom_instructions:
-            system_prompt = f"{SYSTEM_PROMPT}\n\nCUSTOM INSTRUCTIONS:\n{custom_instructions}"
-
-        # If per-request system_message is provided, append it too
-        if request.system_message:
-            system_prompt = f"{system_prompt}\n\nADDITIONAL INSTRUCTIONS:\n{request.system_message}"
-
-        # Prepare messages for Claude
-        messages = []
-
-        # Build context message if previous_design or added_data exists
-        context_parts = []
-
-        if request.previous_design:
-            context_parts.append(
-                f"PREVIOUS DESIGN (for reference/iteration):\n{json.dumps(request.previous_design, indent=2)}"
-            )
-
-        if request.added_data:
-            context_parts.append(
-                f"ADDITIONAL CONTEXT:\n{json.dumps(request.added_data, indent=2)}"
-            )
-
-        # If there's context, add it as a system message first
-        if context_parts:
-            context_message = "\n\n".join(context_parts)
-            messages.append({
-                "role": "user",
-                "content": context_message
-            })
-            # Add assistant acknowledgment
-            messages.append({
-                "role": "assistant",
-                "content": "I've noted the previous design and additional context. I'll use this information to help with the current request."
-            })
-
-        # Add current user message
-        messages.append({
-            "role": "user",
-            "content": request.user_message
-        })
-        print(system_prompt,flush=True)
-        # Call Claude API
-        response = client.messages.create(
-            model="claude-sonnet-4-5-20250929",  # Claude Sonnet 4.5
-            max_tokens=4096,
-            system=system_prompt,
-            messages=messages
-        )
-
-        # Extract response text
-        response_text = response.content[0].text.strip()
-
-        # Parse JSON response
-        try:
-            design_data = json.loads(response_text)
-        except json.JSONDecodeError as e:
-            # Try to extract JSON if Claude wrapped it in markdown
-            if "```json" in response_text:
-                json_start = response_text.find("```json") + 7
-                json_end = response_text.find("```", json_start)
-                response_text = response_text[json_start:json_end].strip()
-                design_data = json.loads(response_text)
-            else:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Failed to parse Claude response as JSON: {str(e)}\nResponse: {response_text}"
-                )
-
-        # Extract explanation if present
-        explanation = design_data.pop("explanation", None)
-
-        # Validate and construct response
-        design = OpticalDesign(**design_data)
-
-        return OpticalDesignResponse(
-            design=design,
-            explanation=explanation
-        )
+        return ORJSONResponse(await generate(request, "design", design_result, DESIGN_TOOL_PARAMS))
 
+    except HTTPException:
+        raise
+    except (asyncio.TimeoutError, anthropic.APITimeoutError):
+        raise HTTPException(status_code=504, detail="Claude did not respond in time")
     except anthropic.APIError as e:
         raise HTTPException(
             status_code=500,
@@ -384,87 +997,80 @@ async def generate_optical_design(request: OpticalDesignRequest):
         )
 
 
-@app.post("/api/chat")
-async def chat_endpoint(request: OpticalDesignRequest):
+@app.post("/api/design/stream")
+async def stream_optical_design(request: OpticalDesignRequest):
     """
-    Alternative endpoint that returns raw Claude response for more flexible chat.
+    Streaming variant of /api/design using Server-Sent Events.
+    Sends an "explanation" event as soon as the explanation is generated and
+    ends with a "design" event carrying the OpticalDesignResponse payload.
     """
-    try:
-        # Build the system prompt - always start with the hardcoded base
-        system_prompt = SYSTEM_PROMPT
-
-        # Append custom instructions from file if they exist
-        custom_instructions = get_custom_instructions()
-        if custom_instructions:
-            system_prompt = f"{SYSTEM_PROMPT}\n\nCUSTOM INSTRUCTIONS:\n{custom_instructions}"
-
-        # If per-request system_message is provided, append it too
-        if request.system_message:
-            system_prompt = f"{system_prompt}\n\nADDITIONAL INSTRUCTIONS:\n{request.system_message}"
+    return stream_response(request, design_result, "design", "Error generating optical design",
+                           DESIGN_TOOL_PARAMS, stream_explanation=True)
 
-        # Prepare messages
-        messages = []
 
-        # Build context message if previous_design or added_data exists
-        context_parts = []
-
-        if request.previous_design:
-            context_parts.append(
-                f"PREVIOUS DESIGN (for reference/iteration):\n{json.dumps(request.previous_design, indent=2)}"
+@app.post("/api/design/batch", responses={200: {"model": BatchDesignResponse}})
+async def create_design_batch(request: BatchDesignRequest):
+    """
+    Submit several design requests through the Message Batches API.
+    Batches run asynchronously at a lower cost than /api/design; poll
+    /api/design/batch/{batch_id} for the results.
+    """
+    batch_requests = [
+        {
+            "custom_id": f"design-{i}",
+            "params": message_params(
+                build_system_blocks(design_request.system_message),
+                build_messages(design_request),
+                design_request.max_tokens or MAX_TOKENS,
+                DESIGN_TOOL_PARAMS
             )
+        }
+        for i, design_request in enumerate(request.requests)
+    ]
 
-        if request.added_data:
-            context_parts.append(
-                f"ADDITIONAL CONTEXT:\n{json.dumps(request.added_data, indent=2)}"
-            )
+    try:
+        batch = await client.messages.batches.create(requests=batch_requests)
+        return ORJSONResponse(batch_status(batch))
+
+    except anthropic.APIError as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Anthropic API error: {str(e)}"
+        )
 
-        # If there's context, add it first
-        if context_parts:
-            context_message = "\n\n".join(context_parts)
-            messages.append({
-                "role": "user",
-                "content": context_message
-            })
-            messages.append({
-                "role": "assistant",
-                "content": "I've noted the previous design and additional context. I'll use this information to help with the current request."
-            })
-
-        messages.append({
-            "role": "user",
-            "content": request.user_message
-        })
 
-        response = client.messages.create(
-            model="claude-sonnet-4-5-20250929",
-            max_tokens=4096,
-            system=system_prompt,
-            messages=messages
+@app.get("/api/design/batch/{batch_id}", responses={200: {"model": BatchDesignResponse}})
+async def get_design_batch(batch_id: str):
+    """
+    Get the status of a design batch, with each request's design (or error)
+    once the batch has ended.
+    """
+    try:
+        batch = await client.messages.batches.retrieve(batch_id)
+        payload = batch_status(batch)
+        if batch.processing_status == "ended":
+            payload["results"] = await batch_results(batch_id)
+        return ORJSONResponse(payload)
+
+    except anthropic.NotFoundError:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    except anthropic.APIError as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Anthropic API error: {str(e)}"
         )
 
-        response_text = response.content[0].text.strip()
 
-        # Try to parse as JSON
-        try:
-            if "```json" in response_text:
-                json_start = response_text.find("```json") + 7
-                json_end = response_text.find("```", json_start)
-                response_text = response_text[json_start:json_end].strip()
-
-            design_data = json.loads(response_text)
-            return {
-                "type": "design",
-                "data": design_data,
-                "raw_response": response_text
-            }
-        except json.JSONDecodeError:
-            # Return as text if not JSON
-            return {
-                "type": "text",
-                "message": response_text,
-                "raw_response": response_text
-            }
+@app.post("/api/chat")
+async def chat_endpoint(request: OpticalDesignRequest):
+    """
+    Alternative endpoint that returns raw Claude response for more flexible chat.
+    """
+    try:
+        return ORJSONResponse(await generate(request, "chat", chat_result))
 
+    except (asyncio.TimeoutError, anthropic.APITimeoutError):
+        raise HTTPException(status_code=504, detail="Claude did not respond in time")
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -472,6 +1078,17 @@ async def chat_endpoint(request: OpticalDesignRequest):
         )
 
 
+@app.post("/api/chat/stream")
+async def stream_chat(request: OpticalDesignRequest):
+    """
+    Streaming variant of /api/chat using Server-Sent Events.
+    Ends with a "chat" event carrying the same payload /api/chat returns.
+    """
+    return stream_response(request, chat_result, "chat", "Error in chat")
+
+
 if __name__ == "__main__":
     import uvicorn
+    # Single-process dev server; uvicorn picks uvloop/httptools itself where
+    # they are installed. Multi-worker production runs use gunicorn.conf.py
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,18 @@
+"""
+Gunicorn configuration for production
+Runs the FastAPI app in Uvicorn workers, which use uvloop and httptools
+(installed with uvicorn[standard]). Start with: gunicorn -c gunicorn.conf.py app:app
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# Override with WEB_CONCURRENCY on memory-constrained hosts
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Claude generations can take well over gunicorn's default 30s
+timeout = 120
+keepalive = 5
@@ -0,0 +1,188 @@
+"""
+Semantic Response Cache
+Embedding-based cache that lets near-duplicate requests reuse a previous
+Claude response instead of making a new API call.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import faiss
+import numpy as np
+import orjson
+from blake3 import blake3
+from sentence_transformers import SentenceTransformer
+
+
+def normalize_message(text: str) -> str:
+    """Lowercase and collapse whitespace so trivial edits map to the same text."""
+    return " ".join(text.lower().split())
+
+
+class SemanticCache:
+    """
+    Cosine-similarity cache over L2-normalized sentence embeddings.
+    Entries live in one FAISS inner-product index per scope and are persisted
+    to SQLite so they survive restarts. Entries expire after ttl_seconds and the least
+    recently used ones are evicted once max_entries is reached.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        model_name: str = "all-MiniLM-L6-v2",
+        threshold: float = 0.93,
+        ttl_seconds: float = 86400,
+        max_entries: int = 1024,
+    ):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        self._model = SentenceTransformer(model_name)
+        self._dim = self._model.get_sentence_embedding_dimension()
+        # scope -> index of that scope's entries, so entries from other scopes
+        # can never crowd an in-scope match out of the nearest neighbours
+        self._indexes: Dict[str, faiss.IndexIDMap2] = {}
+        # id -> (scope, created_at, response), oldest use first
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        # _lock guards the indexes and entries and is never held during disk
+        # I/O; _db_lock serializes use of the shared SQLite connection
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "id INTEGER PRIMARY KEY, scope TEXT NOT NULL, embedding BLOB NOT NULL, "
+            "response TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._load()
+
+    @staticmethod
+    def scope(endpoint: str, system_blocks: List[dict], context_messages: List[dict]) -> str:
+        """
+        Build the exact-match part of the cache key.
+        Only requests with the same endpoint, system prompt and context messages
+        (conversation history, previous design, added data) may share a cached
+        response; the user message is then matched semantically within that scope.
+        """
+        digest = blake3()
+        digest.update(endpoint.encode("utf-8"))
+        for block in system_blocks:
+            digest.update(b"\0")
+            digest.update(block["text"].encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(orjson.dumps(context_messages))
+        return digest.hexdigest()
+
+    def _load(self) -> None:
+        """Load unexpired entries from SQLite into the in-memory index."""
+        cutoff = time.time() - self.ttl_seconds
+        with self._db:
+            self._db.execute("DELETE FROM entries WHERE created_at < ?", (cutoff,))
+        rows = self._db.execute(
+            "SELECT id, scope, embedding, response, created_at FROM entries "
+            "ORDER BY created_at DESC LIMIT ?",
+            (self.max_entries,),
+        ).fetchall()
+
+        for entry_id, scope, embedding, response, created_at in reversed(rows):
+            vector = np.frombuffer(embedding, dtype=np.float32).reshape(1, -1)
+            self._insert(entry_id, vector, scope, created_at, orjson.loads(response))
+
+    def embed(self, user_message: str) -> np.ndarray:
+        """Embed a user message as a (1, dim) float32 unit vector."""
+        vector = self._model.encode(
+            [normalize_message(user_message)],
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+        )
+        return vector.astype(np.float32)
+
+    def lookup(self, embedding: np.ndarray, scope: str) -> Optional[dict]:
+        """
+        Return the cached response closest to embedding within scope,
+        or None if nothing in scope scores above the similarity threshold.
+        """
+        found = None
+        expired = []
+        with self._lock:
+            index = self._indexes.get(scope)
+            if index is None:
+                return None
+
+            # Every hit is in scope; more than one is only needed to skip expired ones
+            k = min(index.ntotal, 8)
+            scores, ids = index.search(embedding, k)
+            now = time.time()
+            for score, entry_id in zip(scores[0], ids[0]):
+                if score < self.threshold:
+                    break
+                entry_id = int(entry_id)
+                entry = self._entries[entry_id]
+                if now - entry[1] > self.ttl_seconds:
+                    self._drop(entry_id)
+                    expired.append(entry_id)
+                    continue
+                self._entries.move_to_end(entry_id)
+                found = entry[2]
+                break
+
+        self._delete_rows(expired)
+        return found
+
+    def add(self, embedding: np.ndarray, scope: str, response: dict) -> None:
+        """Store a response under embedding and persist it to SQLite."""
+        created_at = time.time()
+        with self._db_lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO entries (scope, embedding, response, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (scope, embedding.tobytes(), orjson.dumps(response).decode(), created_at),
+            )
+        entry_id = cursor.lastrowid
+
+        evicted = []
+        with self._lock:
+            self._insert(entry_id, embedding, scope, created_at, response)
+
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                evicted.append(oldest)
+
+        self._delete_rows(evicted)
+
+    def _insert(self, entry_id: int, embedding: np.ndarray, scope: str,
+                created_at: float, response: dict) -> None:
+        """Add an entry to memory and its scope's index. Caller holds _lock."""
+        index = self._indexes.get(scope)
+        if index is None:
+            index = self._indexes[scope] = faiss.IndexIDMap2(faiss.IndexFlatIP(self._dim))
+        index.add_with_ids(embedding, np.array([entry_id], dtype=np.int64))
+        self._entries[entry_id] = (scope, created_at, response)
+
+    def _drop(self, entry_id: int) -> None:
+        """Drop an entry from memory and its scope's index. Caller holds _lock."""
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        index = self._indexes[entry[0]]
+        index.remove_ids(np.array([entry_id], dtype=np.int64))
+        if index.ntotal == 0:
+            del self._indexes[entry[0]]
+
+    def _delete_rows(self, entry_ids: List[int]) -> None:
+        """Delete evicted or expired entries from SQLite."""
+        if not entry_ids:
+            return
+        with self._db_lock, self._db:
+            self._db.executemany("DELETE FROM entries WHERE id = ?", [(i,) for i in entry_ids])
@@ -1,27 +1,28 @@
 """
 Test client for the Optical Design Chat API
 Run this script to test the backend without a frontend.
+Independent tests run concurrently, so the suite takes about as long as its
+slowest test rather than the sum of all Claude calls.
 """
 
-import requests
+import asyncio
+import httpx
 import json
 
 BASE_URL = "https://opdo-v2-chat.onrender.com"
 
 
-def test_health_check():
+async def test_health_check(client: httpx.AsyncClient):
     """Test the health check endpoint"""
+    response = await client.get("/")
     print("\n=== Testing Health Check ===")
-    response = requests.get(f"{BASE_URL}/")
     print(f"Status: {response.status_code}")
     print(f"Response: {response.json()}")
     return response.status_code == 200
 
 
-def test_simple_design():
+async def test_simple_design(client: httpx.AsyncClient):
     """Test generating a simple optical design"""
-    print("\n=== Testing Simple Lens Design ===")
-
     request_data = {
         "user_message": "Design a simple plano-convex lens with 50mm focal length for visible light",
         "system_message": None,
@@ -29,12 +30,10 @@ def test_simple_design():
         "added_data": None
     }
 
-    response = requests.post(
-        f"{BASE_URL}/api/design",
-        json=request_data,
-        headers={"Content-Type": "application/json"}
-    )
+    response = await client.post("/api/design", json=request_data)
 
+    # Printed after the response so concurrent tests' output doesn't interleave
+    print("\n=== Testing Simple Lens Design ===")
     print(f"Status: {response.status_code}")
 
     if response.status_code == 200:
@@ -47,10 +46,8 @@ def test_simple_design():
         return False
 
 
-def test_doublet_design():
+async def test_doublet_design(client: httpx.AsyncClient):
     """Test generating an achromatic doublet"""
-    print("\n=== Testing Achromatic Doublet Design ===")
-
     request_data = {
         "user_message": "Design an achromatic doublet lens system with 100mm focal length and 25mm diameter for astronomy applications",
         "system_message": "Focus on minimizing chromatic aberration across the visible spectrum",
@@ -58,12 +55,10 @@ def test_doublet_design():
         "added_data": {"application": "astronomy", "priority": "chromatic_correction"}
     }
 
-    response = requests.post(
-        f"{BASE_URL}/api/design",
-        json=request_data,
-        headers={"Content-Type": "application/json"}
-    )
+    response = await client.post("/api/design", json=request_data)
 
+    # Printed after the response so concurrent tests' output doesn't interleave
+    print("\n=== Testing Achromatic Doublet Design ===")
     print(f"Status: {response.status_code}")
 
     if response.status_code == 200:
@@ -76,10 +71,8 @@ def test_doublet_design():
         return False
 
 
-def test_with_previous_design():
+async def test_with_previous_design(client: httpx.AsyncClient):
     """Test with previous design for iteration"""
-    print("\n=== Testing With Previous Design (Memory) ===")
-
     # First request
     first_request = {
         "user_message": "Design a simple converging lens",
@@ -88,13 +81,9 @@ def test_with_previous_design():
         "added_data": None
     }
 
-    print("\nFirst request...")
-    response1 = requests.post(
-        f"{BASE_URL}/api/design",
-        json=first_request,
-        headers={"Content-Type": "application/json"}
-    )
+    response1 = await client.post("/api/design", json=first_request)
 
+    print("\n=== Testing With Previous Design (Memory) ===")
     if response1.status_code != 200:
         print(f"First request failed: {response1.text}")
         return False
@@ -111,11 +100,7 @@ def test_with_previous_design():
     }
 
     print("\nSecond request with previous design...")
-    response2 = requests.post(
-        f"{BASE_URL}/api/design",
-        json=second_request,
-        headers={"Content-Type": "application/json"}
-    )
+    response2 = await client.post("/api/design", json=second_request)
 
     print(f"Status: {response2.status_code}")
 
@@ -129,10 +114,8 @@ def test_with_previous_design():
         return False
 
 
-def test_chat_endpoint():
+async def test_chat_endpoint(client: httpx.AsyncClient):
     """Test the chat endpoint"""
-    print("\n=== Testing Chat Endpoint ===")
-
     request_data = {
         "user_message": "Design a microscope objective lens with high numerical aperture",
         "system_message": "Prioritize high resolution and image quality",
@@ -140,12 +123,9 @@ def test_chat_endpoint():
         "added_data": {"target_NA": 0.95, "magnification": "40x"}
     }
 
-    response = requests.post(
-        f"{BASE_URL}/api/chat",
-        json=request_data,
-        headers={"Content-Type": "application/json"}
-    )
+    response = await client.post("/api/chat", json=request_data)
 
+    print("\n=== Testing Chat Endpoint ===")
     print(f"Status: {response.status_code}")
 
     if response.status_code == 200:
@@ -158,28 +138,33 @@ def test_chat_endpoint():
         return False
 
 
-def run_all_tests():
+async def run_all_tests():
     """Run all test cases"""
     print("=" * 60)
     print("OPTICAL DESIGN CHAT API - TEST SUITE")
     print("=" * 60)
 
     tests = [
-        ("Health Check", test_health_check),
         ("Simple Lens Design", test_simple_design),
         ("Achromatic Doublet Design", test_doublet_design),
         ("Chat Endpoint", test_chat_endpoint),
         ("Previous Design Memory", test_with_previous_design),
     ]
 
-    results = []
-    for name, test_func in tests:
-        try:
-            success = test_func()
-            results.append((name, success))
-        except Exception as e:
-            print(f"\nTest '{name}' failed with exception: {str(e)}")
-            results.append((name, False))
+    async with httpx.AsyncClient(base_url=BASE_URL, timeout=120) as client:
+        # Health check first, so a server that isn't up fails fast
+        results = [("Health Check", await test_health_check(client))]
+
+        outcomes = await asyncio.gather(
+            *(test_func(client) for _, test_func in tests),
+            return_exceptions=True
+        )
+
+    for (name, _), outcome in zip(tests, outcomes):
+        if isinstance(outcome, Exception):
+            print(f"\nTest '{name}' failed with exception: {str(outcome)}")
+            outcome = False
+        results.append((name, outcome))
 
     # Summary
     print("\n" + "=" * 60)
@@ -199,7 +184,7 @@ if __name__ == "__main__":
     print("Start it with: python app.py\n")
 
     try:
-        run_all_tests()
-    except requests.exceptions.ConnectionError:
+        asyncio.run(run_all_tests())
+    except httpx.ConnectError:
         print("\n❌ ERROR: Could not connect to server at http://localhost:8000")
         print("Please start the server first: python app.py")
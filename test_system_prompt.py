@@ -1,7 +1,7 @@
 """
 Test script for system prompt management endpoints
 """
-import requests
+import httpx
 import json
 
 BASE_URL = "http://localhost:8000"
@@ -9,7 +9,7 @@ BASE_URL = "http://localhost:8000"
 def test_get_system_prompt():
     """Test GET /api/system-prompt endpoint"""
     print("\n=== Testing GET /api/system-prompt ===")
-    response = requests.get(f"{BASE_URL}/api/system-prompt")
+    response = httpx.get(f"{BASE_URL}/api/system-prompt")
     print(f"Status Code: {response.status_code}")
     if response.status_code == 200:
         data = response.json()
@@ -29,7 +29,7 @@ Test prompt content goes here with optical design requirements.
 
 IMPORTANT: This is just a test prompt for verification."""
 
-    response = requests.post(
+    response = httpx.post(
         f"{BASE_URL}/api/system-prompt",
         json={"content": test_prompt}
     )
@@ -45,7 +45,7 @@ IMPORTANT: This is just a test prompt for verification."""
 def test_get_after_post():
     """Verify the saved prompt can be retrieved"""
     print("\n=== Testing GET after POST ===")
-    response = requests.get(f"{BASE_URL}/api/system-prompt")
+    response = httpx.get(f"{BASE_URL}/api/system-prompt")
     print(f"Status Code: {response.status_code}")
     if response.status_code == 200:
         data = response.json()
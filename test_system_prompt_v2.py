@@ -2,7 +2,7 @@
 Test script for updated system prompt management endpoints
 Tests the new behavior where base prompt is hardcoded and custom instructions are appended
 """
-import requests
+import httpx
 import json
 
 BASE_URL = "http://localhost:8000"
@@ -10,7 +10,7 @@ BASE_URL = "http://localhost:8000"
 def test_get_empty_custom_instructions():
     """Test GET /api/system-prompt when no custom instructions exist"""
     print("\n=== Test 1: GET custom instructions (should be empty initially) ===")
-    response = requests.get(f"{BASE_URL}/api/system-prompt")
+    response = httpx.get(f"{BASE_URL}/api/system-prompt")
     print(f"Status Code: {response.status_code}")
     if response.status_code == 200:
         data = response.json()
@@ -26,7 +26,7 @@ def test_get_empty_custom_instructions():
 def test_delete_custom_instructions():
     """Test DELETE /api/system-prompt to clear instructions"""
     print("\n=== Test 2: DELETE custom instructions ===")
-    response = requests.delete(f"{BASE_URL}/api/system-prompt")
+    response = httpx.delete(f"{BASE_URL}/api/system-prompt")
     print(f"Status Code: {response.status_code}")
     if response.status_code == 200:
         data = response.json()
@@ -43,7 +43,7 @@ def test_post_custom_instructions():
 Prefer standard materials like BK7 when possible.
 Provide detailed explanations for material choices."""
 
-    response = requests.post(
+    response = httpx.post(
         f"{BASE_URL}/api/system-prompt",
         json={"content": custom_instructions}
     )
@@ -58,7 +58,7 @@ Provide detailed explanations for material choices."""
 def test_get_custom_instructions():
     """Test GET after POST to verify custom instructions"""
     print("\n=== Test 4: GET custom instructions after POST ===")
-    response = requests.get(f"{BASE_URL}/api/system-prompt")
+    response = httpx.get(f"{BASE_URL}/api/system-prompt")
     print(f"Status Code: {response.status_code}")
     if response.status_code == 200:
         data = response.json()
@@ -80,7 +80,7 @@ def test_design_endpoint():
         "user_message": "Design a simple singlet lens with 50mm focal length for visible light"
     }
 
-    response = requests.post(
+    response = httpx.post(
         f"{BASE_URL}/api/design",
         json=design_request,
         timeout=30
@@ -100,11 +100,11 @@ def test_clear_and_verify():
     print("\n=== Test 6: Clear instructions and verify ===")
 
     # Clear
-    response = requests.delete(f"{BASE_URL}/api/system-prompt")
+    response = httpx.delete(f"{BASE_URL}/api/system-prompt")
     print(f"DELETE Status: {response.status_code}")
 
     # Verify
-    response = requests.get(f"{BASE_URL}/api/system-prompt")
+    response = httpx.get(f"{BASE_URL}/api/system-prompt")
     print(f"GET Status: {response.status_code}")
     if response.status_code == 200:
         data = response.json()
@@ -130,7 +130,7 @@ if __name__ == "__main__":
         print("\n" + "=" * 70)
         print("All tests completed!")
         print("=" * 70)
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
         print("\nError: Could not connect to server. Is it running on localhost:8000?")
     except Exception as e:
         print(f"\nError during testing: {e}")